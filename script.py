@@ -1,15 +1,78 @@
 import io
 import time
+import shutil
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import csv
 from datetime import datetime
 from decouple import config
 import argparse
+import threading
+from collections import defaultdict
+
+try:
+    import orjson  # ~3-5x faster JSON decode, straight from bytes
+except ImportError:
+    orjson = None
+from concurrent.futures import ThreadPoolExecutor
 
 ENDPOINTS_DATA = '/api/data/crm'
 ENDPOINTS_SUBMISSION = '/api/data/form-submissions'
 
+class TokenBucket:
+    """Token-bucket rate limiter: bursts up to `capacity` requests, then
+    throttles to `rate` requests per second"""
+    def __init__(self, capacity=5, rate=0.5):
+        self.capacity = capacity
+        self.rate = rate
+        self.tokens = capacity
+        self.last_refill = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Take one token, sleeping only if the burst budget is exhausted"""
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.last_refill) * self.rate)
+            self.last_refill = now
+            if self.tokens < 1:
+                wait = (1 - self.tokens) / self.rate
+                time.sleep(wait)
+                self.last_refill = time.monotonic()
+                self.tokens = 0
+            else:
+                self.tokens -= 1
+
 class CRMUpdater:
+    # Map common field variations from the form submissions API
+    FIELD_MAPPINGS = {
+        'id': ['id', 'contact_id', 'user_id', 'submission_id'],
+        'first': ['first', 'first_name', 'firstName', 'fname'],
+        'last': ['last', 'last_name', 'lastName', 'lname'],
+        'email': ['email', 'email_address', 'user_email'],
+        'phone': ['phone', 'phone_number', 'mobile', 'telephone'],
+        'feedback': ['feedback', 'comments', 'message', 'review', 'notes'],
+        'submission_date': ['submission_date', 'created_at', 'timestamp', 'date', 'submitted_at'],
+        'event': ['event', 'event_name', 'event_title'],
+        'rating': ['rating', 'score', 'satisfaction']
+    }
+    # Flattened alias -> canonical key map so normalisation is one pass
+    _ALIAS_MAP = {alias: canon for canon, aliases in FIELD_MAPPINGS.items() for alias in aliases}
+    _CANON_KEYS = tuple(FIELD_MAPPINGS)
+
+    # Internal field name -> CRM CSV column header (which uses spaces)
+    _FIELD_MAP = (
+        ('id', 'id'),
+        ('first', 'first'),
+        ('last', 'last'),
+        ('email', 'email'),
+        ('phone', 'phone'),
+        ('last_contact_date', 'last contact date'),
+        ('last_contact_text', 'last contact text'),
+        ('all_contact_text', 'all contact text'),
+    )
+
     def __init__(self, debug=False):
         self.base_url = "https://it-hiring.blackbird.vc"
         self.access_token = config('ACCESS_TOKEN')
@@ -17,32 +80,48 @@ class CRMUpdater:
             'Authorization': f'Bearer {self.access_token}',
             'Content-Type': 'application/json'
         }
-        self.rate_limit_delay = (10 / 5) + 0.1  # Keep < 5 req / 10s
+        self.bucket = TokenBucket(capacity=5, rate=0.5)  # Burst of 5, then 1 req / 2s sustained
         self.debug = debug
+        # Reuse one pooled session so repeat calls keep the TCP/TLS connection alive,
+        # with transparent retries on transient failures instead of giving up
+        retry = Retry(
+            total=5,
+            backoff_factor=0.5,
+            status_forcelist=[429, 500, 502, 503, 504],
+            allowed_methods=['GET'],
+            respect_retry_after_header=True
+        )
+        self.session = requests.Session()
+        self.session.headers.update(self.headers)
+        self.session.mount('https://', HTTPAdapter(pool_connections=4, pool_maxsize=10, max_retries=retry))
 
-    def make_api_request(self, endpoint: str, response_format: str = 'json'):
+    def make_api_request(self, endpoint: str, response_format: str = 'json', stream: bool = False):
         """Make API requests with rate limiting and error handling"""
         url = f"{self.base_url}{endpoint}"
         try:
             if self.debug:
                 print(f"Making request to: {url}")
-            response = requests.get(url, headers=self.headers, timeout=30)
-            time.sleep(self.rate_limit_delay)
-            
+            self.bucket.acquire()
+            response = self.session.get(url, timeout=30, stream=stream)
+
             if self.debug:
                 print(f"Status code: {response.status_code}")
-                print(f"Raw response: {repr(response.text)[:300]}...")
+                if not stream:
+                    print(f"Raw response: {repr(response.text)[:300]}...")
 
             if response.status_code == 200:
                 if response_format == 'json':
                     try:
+                        if orjson is not None:
+                            return orjson.loads(response.content)
                         return response.json()
                     except ValueError as json_err:
                         if self.debug:
                             print(f"JSON decode error: {json_err}")
                         return None
                 elif response_format == 'csv':
-                    return response.text
+                    # Streaming callers consume the body themselves
+                    return response if stream else response.text
                 else:
                     if self.debug:
                         print(f"Unknown response format: {response_format}")
@@ -57,23 +136,40 @@ class CRMUpdater:
             return None
 
     def get_crm_data(self):
-        """Get CRM contact data"""
+        """Get CRM contact data as a lazy iterator over rows"""
         print("Fetching CRM contact data...")
-        response_text = self.make_api_request(ENDPOINTS_DATA, response_format='csv')
-        
-        if not response_text:
+        response = self.make_api_request(ENDPOINTS_DATA, response_format='csv', stream=True)
+
+        if not response:
             print("No CRM data found or invalid response format")
-            return []
-        
-        try:
-            csv_file = io.StringIO(response_text)
-            reader = csv.DictReader(csv_file)
-            contacts = list(reader)
-            print(f"Successfully parsed {len(contacts)} CRM contacts")
-            return contacts
-        except Exception as e:
-            print(f"CSV parsing error: {e}")
-            return []
+            return iter(())
+
+        return self._iter_csv_rows(response)
+
+    def _iter_csv_rows(self, response):
+        """Yield one normalised contact dict per CSV row, streaming straight
+        off the response instead of buffering the whole body in memory.
+        Mid-stream errors propagate to the consumer so a partial read is
+        never mistaken for a complete contact list"""
+        with response:
+            # Wrap the raw stream as text with line terminators intact;
+            # iter_lines would strip the newlines inside quoted multiline
+            # fields and silently corrupt the contact history
+            response.raw.decode_content = True
+            # urllib3 closes the raw response as soon as the body is fully
+            # read, which would make TextIOWrapper's EOF read blow up
+            response.raw.auto_close = False
+            text_stream = io.TextIOWrapper(response.raw, encoding=response.encoding or 'utf-8', newline='')
+            reader = csv.reader(text_stream)
+            header = next(reader, None)
+            if header is None:
+                return
+            idx = {name: i for i, name in enumerate(header)}
+            # Resolve each field's column position once for the whole file
+            positions = tuple((key, idx[col]) for key, col in self._FIELD_MAP)
+            for row in reader:
+                if row:
+                    yield self.normalise_contact_data(row, positions)
 
     def get_form_submissions(self):
         """Fetch event feedback form submissions"""
@@ -99,54 +195,36 @@ class CRMUpdater:
                 print(f"Unexpected data format for submissions: {type(data)}")
             return []
 
-    def normalise_contact_data(self, contact):
-        """Normalise the contact data structure to match CRM schema"""
-        # The CRM data uses exact column names with spaces
-        return {
-            'id': contact.get('id', '').strip(),
-            'first': contact.get('first', '').strip(),
-            'last': contact.get('last', '').strip(),
-            'email': contact.get('email', '').strip(),
-            'phone': contact.get('phone', '').strip(),
-            'last_contact_date': contact.get('last contact date', '').strip(),
-            'last_contact_text': contact.get('last contact text', '').strip(),
-            'all_contact_text': contact.get('all contact text', '').strip()
-        }
+    @staticmethod
+    def parse_date(date_str):
+        """Parse an ISO date string once, returning None when it is empty
+        or unparseable"""
+        if not date_str:
+            return None
+        try:
+            return datetime.fromisoformat(date_str.replace('Z', '+00:00').split('T')[0])
+        except (ValueError, TypeError):
+            return None
+
+    def normalise_contact_data(self, row, positions):
+        """Normalise a raw CSV row to the internal contact schema using
+        column positions resolved once from the header"""
+        contact = {key: row[i].strip() for key, i in positions}
+        contact['_date'] = self.parse_date(contact['last_contact_date'])
+        return contact
 
     def normalise_submission_data(self, submission):
         """Normalise form submission data structure"""
-        # Handle various possible field names from the form submissions API
-        normalised = {
-            'id': '',
-            'first': '',
-            'last': '',
-            'email': '',
-            'phone': '',
-            'feedback': '',
-            'submission_date': '',
-            'event': '',
-            'rating': ''
-        }
-        
-        # Map common field variations
-        field_mappings = {
-            'id': ['id', 'contact_id', 'user_id', 'submission_id'],
-            'first': ['first', 'first_name', 'firstName', 'fname'],
-            'last': ['last', 'last_name', 'lastName', 'lname'],
-            'email': ['email', 'email_address', 'user_email'],
-            'phone': ['phone', 'phone_number', 'mobile', 'telephone'],
-            'feedback': ['feedback', 'comments', 'message', 'review', 'notes'],
-            'submission_date': ['submission_date', 'created_at', 'timestamp', 'date', 'submitted_at'],
-            'event': ['event', 'event_name', 'event_title'],
-            'rating': ['rating', 'score', 'satisfaction']
-        }
-        
-        for normalised_key, possible_keys in field_mappings.items():
-            for key in possible_keys:
-                if key in submission and submission[key]:
-                    normalised[normalised_key] = str(submission[key]).strip()
-                    break
-        
+        normalised = dict.fromkeys(self._CANON_KEYS, '')
+
+        # Single pass over the submission fields via the flattened alias map;
+        # JSON string fields are the common case, so skip the str() round-trip
+        for key, value in submission.items():
+            canon = self._ALIAS_MAP.get(key)
+            if canon and value and not normalised[canon]:
+                normalised[canon] = value.strip() if isinstance(value, str) else str(value).strip()
+
+        normalised['_date'] = self.parse_date(normalised['submission_date'])
         return normalised
 
     def is_data_missing_or_outdated(self, contact, submission):
@@ -176,154 +254,175 @@ class CRMUpdater:
                     print(f"  No last contact date for {contact.get('email', 'unknown')}")
                 return True
                 
-            # Check if submission is more recent than last contact
-            try:
-                submission_date_str = submission.get('submission_date', '')
-                last_contact_date_str = contact.get('last_contact_date', '')
-                
-                if submission_date_str and last_contact_date_str:
-                    # Parse dates (handle various formats)
-                    submission_date = datetime.fromisoformat(submission_date_str.replace('s', '+00:00').split('T')[0])
-                    last_contact_date = datetime.fromisoformat(last_contact_date_str.replace('s', '+00:00').split('T')[0])
-                    
-                    if submission_date > last_contact_date:
-                        if self.debug:
-                            print(f"  Newer feedback available for {contact.get('email', 'unknown')}")
-                        return True
-            except (ValueError, TypeError) as e:
-                if self.debug:
-                    print(f"  Date parsing issue for {contact.get('email', 'unknown')}: {e}")
-                # If date parsing fails, assume we should update
-                return True
+            # Check if submission is more recent than last contact,
+            # using the dates parsed once during normalisation
+            if submission.get('submission_date'):
+                submission_date = submission.get('_date')
+                last_contact_date = contact.get('_date')
+
+                if submission_date is None or last_contact_date is None:
+                    if self.debug:
+                        print(f"  Date parsing issue for {contact.get('email', 'unknown')}")
+                    # If date parsing failed, assume we should update
+                    return True
+
+                if submission_date > last_contact_date:
+                    if self.debug:
+                        print(f"  Newer feedback available for {contact.get('email', 'unknown')}")
+                    return True
         
         return False
 
-    def update_contact_with_feedback(self, contact, submission):
-        """Update contact record with the feedback data"""
-        updated_contact = contact.copy()
-        
+    @staticmethod
+    def _format_feedback(submission):
+        """Build the formatted feedback message for a submission"""
+        event_info = f" about {submission['event']}" if submission.get('event') else ""
+        rating_info = f" (Rating: {submission['rating']})" if submission.get('rating') else ""
+        return f"Event feedback{event_info}: {submission['feedback']}{rating_info}"
+
+    def update_contact_with_feedback(self, contact, submission, new_entries):
+        """Update a contact record in place with the feedback data; the
+        normalised contact dicts are freshly built, so mutation is safe.
+        History entries are collected into new_entries and joined once by
+        the caller rather than re-concatenated per submission"""
         # Update missing fields
-        if not updated_contact.get('phone') and submission.get('phone'):
-            updated_contact['phone'] = submission['phone']
+        if not contact.get('phone') and submission.get('phone'):
+            contact['phone'] = submission['phone']
             if self.debug:
                 print(f"    Added phone: {submission['phone']}")
-        
-        if not updated_contact.get('first') and submission.get('first'):
-            updated_contact['first'] = submission['first']
+
+        if not contact.get('first') and submission.get('first'):
+            contact['first'] = submission['first']
             if self.debug:
                 print(f"    Added first name: {submission['first']}")
-            
-        if not updated_contact.get('last') and submission.get('last'):
-            updated_contact['last'] = submission['last']
+
+        if not contact.get('last') and submission.get('last'):
+            contact['last'] = submission['last']
             if self.debug:
                 print(f"    Added last name: {submission['last']}")
-        
+
         # Update contact information with feedback
         if submission.get('feedback'):
-            # Format the feedback message
-            event_info = f" about {submission['event']}" if submission.get('event') else ""
-            rating_info = f" (Rating: {submission['rating']})" if submission.get('rating') else ""
-            
-            feedback_text = f"Event feedback{event_info}: {submission['feedback']}{rating_info}"
-            
+            feedback_text = self._format_feedback(submission)
+
             # Update last contact info
-            updated_contact['last_contact_text'] = feedback_text
-            updated_contact['last_contact_date'] = submission.get('submission_date', datetime.now().strftime('%Y-%m-%d'))
-            
-            # Append to all contact text (preserve existing history)
-            existing_text = updated_contact.get('all_contact_text', '').strip()
-            new_entry = f"{updated_contact['last_contact_date']} - {feedback_text}"
-            
-            if existing_text:
-                updated_contact['all_contact_text'] = f"{existing_text}\n \n {new_entry}"
-            else:
-                updated_contact['all_contact_text'] = new_entry
-                
+            contact['last_contact_text'] = feedback_text
+            contact['last_contact_date'] = submission.get('submission_date') or datetime.now().strftime('%Y-%m-%d')
+            # Keep the cached parsed date in sync for later comparisons
+            contact['_date'] = submission.get('_date') or self.parse_date(contact['last_contact_date'])
+
+            # Queue the history entry; the caller appends the batch once
+            new_entries.append(f"{contact['last_contact_date']} - {feedback_text}")
+
             if self.debug:
                 print(f"    Added feedback: {submission['feedback'][:50]}...")
-        
-        return updated_contact
+
+        return contact
 
     def process_and_update_contacts(self):
         """Main processing logic to update contacts with feedback"""
         print("Processing contact updates...")
         
-        # Get data from both endpoints
-        crm_contacts = self.get_crm_data()
-        form_submissions = self.get_form_submissions()
+        # Get data from both endpoints concurrently; they are independent,
+        # so overlapping the two fetches halves the network wait
+        with ThreadPoolExecutor(max_workers=2) as pool:
+            crm_future = pool.submit(self.get_crm_data)
+            submissions_future = pool.submit(self.get_form_submissions)
+            crm_contacts = crm_future.result()
+            form_submissions = submissions_future.result()
         
-        if not crm_contacts:
-            print("No CRM contacts found")
+        # Normalise data (contacts stream off the response already normalised);
+        # fail closed on a mid-stream error rather than writing a partial CRM
+        try:
+            normalised_contacts = list(crm_contacts)
+        except Exception as e:
+            print(f"CSV parsing error: {e}")
             return []
-        
-        # Normalise data
-        normalised_contacts = [self.normalise_contact_data(contact) for contact in crm_contacts]
         normalised_submissions = [self.normalise_submission_data(sub) for sub in form_submissions]
+
+        if not normalised_contacts:
+            print("No CRM contacts found")
+            return []
         
         print(f"Processing {len(normalised_contacts)} contacts with {len(normalised_submissions)} submissions")
         
         # Create lookup dictionaries for submissions
-        submissions_by_email = {}
-        submissions_by_id = {}
-        
+        submissions_by_email = defaultdict(list)
+        submissions_by_id = defaultdict(list)
+
         for submission in normalised_submissions:
             if submission.get('email'):
-                email_key = submission['email'].lower()
-                if email_key not in submissions_by_email:
-                    submissions_by_email[email_key] = []
-                submissions_by_email[email_key].append(submission)
-            
+                submissions_by_email[submission['email'].lower()].append(submission)
+
             if submission.get('id'):
-                id_key = submission['id']
-                if id_key not in submissions_by_id:
-                    submissions_by_id[id_key] = []
-                submissions_by_id[id_key].append(submission)
+                submissions_by_id[submission['id']].append(submission)
         
         updated_contacts = []
         update_count = 0
-        
+
+        # Track existing keys while the main loop visits each contact anyway,
+        # for the new-contact pass below
+        existing_emails = set()
+        existing_ids = set()
+
         for contact in normalised_contacts:
+            email_lower = contact['email'].lower() if contact.get('email') else ''
+
+            if email_lower:
+                existing_emails.add(email_lower)
+            if contact.get('id'):
+                existing_ids.add(contact['id'])
+
             # Try to find matching submissions
             matching_submissions = []
-            
+
             # First try to match by contact ID
             if contact.get('id') and contact['id'] in submissions_by_id:
                 matching_submissions.extend(submissions_by_id[contact['id']])
-            
+
             # Then try to match by email
-            if contact.get('email') and contact['email'].lower() in submissions_by_email:
-                matching_submissions.extend(submissions_by_email[contact['email'].lower()])
-            
-            # Remove duplicates while preserving order
+            if email_lower and email_lower in submissions_by_email:
+                matching_submissions.extend(submissions_by_email[email_lower])
+
+            # Most contacts never submitted feedback; skip the dedup and
+            # update machinery entirely for them
+            if not matching_submissions:
+                updated_contacts.append(contact)
+                continue
+
+            # Remove duplicates while preserving order; both lookup dicts
+            # hold the same submission objects, so identity is enough
             seen = set()
             unique_submissions = []
             for sub in matching_submissions:
-                sub_key = (sub.get('email', ''), sub.get('feedback', ''), sub.get('submission_date', ''))
-                if sub_key not in seen:
-                    seen.add(sub_key)
+                if id(sub) not in seen:
+                    seen.add(id(sub))
                     unique_submissions.append(sub)
             
-            # Process each matching submission
-            current_contact = contact
+            # Process each matching submission, updating the contact in place
             contact_updated = False
-            
+            new_entries = []
+
             for submission in unique_submissions:
-                if self.is_data_missing_or_outdated(current_contact, submission):
-                    print(f"Updating contact: {current_contact.get('email', 'Unknown email')}")
-                    current_contact = self.update_contact_with_feedback(current_contact, submission)
+                if self.is_data_missing_or_outdated(contact, submission):
+                    print(f"Updating contact: {contact.get('email', 'Unknown email')}")
+                    self.update_contact_with_feedback(contact, submission, new_entries)
                     contact_updated = True
-            
+
+            # Append the collected history entries in one join instead of
+            # re-copying the full history string per submission
+            if new_entries:
+                existing_text = contact.get('all_contact_text', '').strip()
+                contact['all_contact_text'] = "\n \n ".join(filter(None, [existing_text, *new_entries]))
+
             if contact_updated:
                 update_count += 1
-            
-            updated_contacts.append(current_contact)
+
+            updated_contacts.append(contact)
         
         print(f"Updated {update_count} contacts out of {len(normalised_contacts)}")
         
         # Add any new contacts from submissions that don't exist in CRM
-        existing_emails = {contact.get('email', '').lower() for contact in normalised_contacts if contact.get('email')}
-        existing_ids = {contact.get('id') for contact in normalised_contacts if contact.get('id')}
-        
         new_contact_count = 0
         for submission in normalised_submissions:
             submission_email = submission.get('email', '').lower()
@@ -335,10 +434,8 @@ class CRMUpdater:
                 submission.get('feedback')):
                 
                 # Create new contact from submission
-                event_info = f" about {submission['event']}" if submission.get('event') else ""
-                rating_info = f" (Rating: {submission['rating']})" if submission.get('rating') else ""
-                feedback_text = f"Event feedback{event_info}: {submission['feedback']}{rating_info}"
-                
+                feedback_text = self._format_feedback(submission)
+
                 new_contact = {
                     'id': submission_id or f"new-{len(updated_contacts) + 1}",
                     'first': submission.get('first', ''),
@@ -365,50 +462,56 @@ class CRMUpdater:
             return
         
         print(f"Creating CSV file: {filename}")
-        
-        # Use the exact required column names
+
+        # Use the exact required column names, in order
         fieldnames = ['id', 'first', 'last', 'email', 'phone', 'last contact date', 'last contact text', 'all contact text']
-        
+        # Internal normalised field names, in the same order as fieldnames
+        keys = ('id', 'first', 'last', 'email', 'phone', 'last_contact_date', 'last_contact_text', 'all_contact_text')
+
         try:
             with open(filename, 'w', newline='', encoding='utf-8') as csvfile:
-                writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
-                writer.writeheader()
-                
-                for contact in contacts:
-                    # Map our normalised field names to the required CSV column names
-                    row = {
-                        'id': contact.get('id', ''),
-                        'first': contact.get('first', ''),
-                        'last': contact.get('last', ''),
-                        'email': contact.get('email', ''),
-                        'phone': contact.get('phone', ''),
-                        'last contact date': contact.get('last_contact_date', ''),
-                        'last contact text': contact.get('last_contact_text', ''),
-                        'all contact text': contact.get('all_contact_text', '')
-                    }
-                    writer.writerow(row)
-            
+                writer = csv.writer(csvfile)
+                writer.writerow(fieldnames)
+                writer.writerows((contact.get(k, '') for k in keys) for contact in contacts)
+
             print(f"Successfully created CSV file: {filename}")
             print(f"Wrote {len(contacts)} contacts to file")
             
         except Exception as e:
             print(f"Error creating CSV file: {e}")
 
+    def download_to_file(self, endpoint: str, path: str):
+        """Stream an endpoint's response straight to disk without holding
+        the body in memory; returns True on success"""
+        url = f"{self.base_url}{endpoint}"
+        try:
+            self.bucket.acquire()
+            with self.session.get(url, timeout=30, stream=True) as response:
+                if response.status_code != 200:
+                    if self.debug:
+                        print(f"API Request failed: STATUS {response.status_code}")
+                    return False
+                # Let urllib3 undo any transfer encoding before it hits disk
+                response.raw.decode_content = True
+                with open(path, 'wb') as f:
+                    shutil.copyfileobj(response.raw, f)
+            return True
+        except (requests.exceptions.RequestException, OSError) as e:
+            print(f"Error saving {path}: {e}")
+            return False
+
     def download_original_csv(self, filename: str = "original_crm_contacts.csv"):
         """Download and save the original CRM CSV file for comparison"""
         if self.debug:
             print(f"Downloading original CRM CSV to {filename}...")
-        response_text = self.make_api_request(ENDPOINTS_DATA, response_format='csv')
-        if not response_text:
+        if not self.download_to_file(ENDPOINTS_DATA, filename):
             print("Failed to download original CRM CSV.")
-            return
-        try:
-            with open(filename, 'w', encoding='utf-8') as f:
-                f.write(response_text)
-            if self.debug:
-                print(f"Original CRM CSV saved as {filename}")
-        except Exception as e:
-            print(f"Error saving original CRM CSV: {e}")
+        elif self.debug:
+            print(f"Original CRM CSV saved as {filename}")
+
+    def close(self):
+        """Release the pooled HTTP connections"""
+        self.session.close()
 
     def run(self):
         """Run the updater"""
@@ -421,8 +524,11 @@ class CRMUpdater:
             self.download_original_csv()
         
         # Process and update contacts
-        updated_contacts = self.process_and_update_contacts()
-        
+        try:
+            updated_contacts = self.process_and_update_contacts()
+        finally:
+            self.close()
+
         if updated_contacts:
             # Create the required output file
             self.create_csv(updated_contacts, "crm-update.csv")